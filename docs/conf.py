@@ -18,6 +18,7 @@ from os.path import isdir, isfile, join, basename, dirname
 from os import makedirs, getenv
 from shutil import copyfile
 from subprocess import run, STDOUT
+import json
 
 # -- Project information -----------------------------------------------------
 
@@ -95,14 +96,14 @@ def module_version(module, version):
     return version
 
 def gomod_versions(modules):
-    versions = {}
-    gocmd = run(['go', 'list', '-m', '-f', '{{.GoVersion}}'],
+    # Parse go.mod once instead of forking 'go list -m' for every module.
+    gocmd = run(['go', 'mod', 'edit', '-json'],
                 check=True, capture_output=True, universal_newlines=True)
-    versions['golang'] = gocmd.stdout.strip()
+    gomod = json.loads(gocmd.stdout)
+    required = {r['Path']: r['Version'] for r in gomod.get('Require', [])}
+    versions = {'golang': gomod['Go']}
     for m in modules:
-        gocmd = run(['go', 'list', '-m', '-f', '{{.Version}}', '%s' % m],
-                    check=True, capture_output=True, universal_newlines=True)
-        versions[m] = module_version(m, gocmd.stdout.strip())
+        versions[m] = module_version(m, required[m])
     return versions
 
 mod_versions = gomod_versions(['github.com/intel/goresctrl'])
@@ -3,8 +3,8 @@
 """topology2qemuopts - convert NUMA node list from JSON to Qemu options
 
 NUMA node group definitions:
-"mem"                 mem (RAM) size on each NUMA node in this group.
-                      The default is "0G".
+"mem"                 mem (RAM) size on each NUMA node in this group,
+                      for instance "2G" or "512M". The default is "0G".
 "nvmem"               nvmem (non-volatile RAM) size on each NUMA node
                       in this group. The default is "0G".
 "dimm"                "": the default, memory is there without pc-dimm defined.
@@ -79,13 +79,39 @@ EOF
 
 import os
 import sys
-import json
+
+try:
+    import orjson as json
+except ImportError:
+    import json
 
 DEFAULT_DIST = 21
 DEFAULT_DIST_SAME_PACKAGE = 21
 DEFAULT_DIST_SAME_DIE = 11
 DEFAULT_DIST_SAME_NODE = 10
 
+VALID_KEYS = frozenset(("mem", "nvmem", "dimm",
+                        "cores", "threads", "nodes", "dies", "packages",
+                        "node-dist", "dist-all",
+                        "dist-other-package", "dist-same-package", "dist-same-die"))
+
+# Integer keys: (description of valid values, smallest valid value)
+INT_RANGE_KEYS = {'cores': ('>= 0', 0),
+                  'threads': ('> 0', 1),
+                  'nodes': ('> 0', 1),
+                  'dies': ('> 0', 1),
+                  'packages': ('> 0', 1)}
+
+# Templates for Qemu option values
+MEMDEV_ID = "%s_%s_node_%s"
+MEMORY_BACKEND = "memory-backend-ram,size=%s,id=%s"
+PC_DIMM_DEVICE = "pc-dimm,node=%s,id=dimm%s,memdev=%s"
+NVDIMM_DEVICE = "nvdimm,node=%s,id=nvdimm%s,memdev=%s"
+NUMA_NODE = "node,nodeid=%s"
+NUMA_NODE_MEMDEV = "node,nodeid=%s,memdev=%s"
+NUMA_NODE_CPUS = ",cpus=%s-%s"
+NUMA_DIST = "dist,src=%s,dst=%s,val=%s"
+
 separated_output_vars = (os.environ['SEPARATED_OUTPUT_VARS'] == '1')
 
 def error(msg, exitstatus=1):
@@ -93,33 +119,28 @@ def error(msg, exitstatus=1):
     if exitstatus is not None:
         sys.exit(exitstatus)
 
-def siadd(s1, s2):
-    if s1.lower().endswith("g") and s2.lower().endswith("g"):
-        return str(int(s1[:-1]) + int(s2[:-1])) + "G"
-    raise ValueError('supports only sizes in gigabytes, example: 2G')
+def si2mb(s):
+    if s == "0":
+        return 0
+    if s.lower().endswith("g"):
+        return int(s[:-1]) * 1024
+    if s.lower().endswith("m"):
+        return int(s[:-1])
+    raise ValueError('supports only sizes in gigabytes or megabytes, example: 2G')
 
-def sisub(s1, s2):
-    if s1.lower().endswith("g") and s2.lower().endswith("g"):
-        return str(int(s1[:-1]) - int(s2[:-1])) + "G"
-    raise ValueError('supports only sizes in gigabytes, example: 2G')
+def mb2si(mb):
+    if mb % 1024 == 0:
+        return "%sG" % (mb // 1024,)
+    return "%sM" % (mb,)
 
 def validate(numalist):
     if not isinstance(numalist, list):
         raise ValueError('expected list containing dicts, got %s' % (type(numalist,).__name__))
-    valid_keys = set(("mem", "nvmem", "dimm",
-                      "cores", "threads", "nodes", "dies", "packages",
-                      "node-dist", "dist-all",
-                      "dist-other-package", "dist-same-package", "dist-same-die"))
-    int_range_keys = {'cores': ('>= 0', lambda v: v >= 0),
-                      'threads': ('> 0', lambda v: v > 0),
-                      'nodes': ('> 0', lambda v: v > 0),
-                      'dies': ('> 0', lambda v: v > 0),
-                      'packages': ('> 0', lambda v: v > 0)}
     for numalistindex, numaspec in enumerate(numalist):
         for key in numaspec:
-            if not key in valid_keys:
+            if not key in VALID_KEYS:
                 raise ValueError('invalid name %r in node %r' % (key, numaspec))
-            if key in ["mem", "nvmem"]:
+            if key in ("mem", "nvmem"):
                 val = numaspec.get(key)
                 if val == "0":
                     continue
@@ -127,33 +148,59 @@ def validate(numalist):
                 if not isinstance(val, str):
                     raise ValueError(errmsg)
                 try:
-                    siadd(val, "0G")
+                    si2mb(val)
                 except ValueError:
                     raise ValueError(errmsg)
-            if key in int_range_keys:
+            if key in INT_RANGE_KEYS:
+                description, minimum = INT_RANGE_KEYS[key]
                 try:
                     val = int(numaspec[key])
-                    if not int_range_keys[key][1](val):
-                        raise Exception()
-                except:
-                    raise ValueError('invalid %s in node %r, expected integer %s' % (key, numaspec, int_range_keys[key][0]))
+                except (TypeError, ValueError):
+                    val = None
+                if val is None or val < minimum:
+                    raise ValueError('invalid %s in node %r, expected integer %s' % (key, numaspec, description))
         if 'threads' in numaspec and int(numaspec.get('cores', 0)) == 0:
             raise ValueError('threads set to %s but "cores" is 0 in node %r' % (numaspec["threads"], numaspec))
 
+def fill_dists(package_die, node_node_dist, dist_same_die, dist_same_package, dist_other_package):
+    # Return rows of distances between nodes located at package_die[node]
+    # == (package, die), with explicit node_node_dist overrides applied.
+    # Nodes on the same die share the same row apart from the diagonal,
+    # so each distinct row is computed only once.
+    die_rows = {}
+    dist_rows = []
+    for sourcenode, (package, die) in enumerate(package_die):
+        if (package, die) not in die_rows:
+            die_rows[(package, die)] = [
+                dist_same_die if dest_package_die == (package, die) else
+                dist_same_package if dest_package_die[0] == package else
+                dist_other_package
+                for dest_package_die in package_die]
+        row = list(die_rows[(package, die)])
+        row[sourcenode] = DEFAULT_DIST_SAME_NODE
+        dist_rows.append(row)
+    # User specified explicit node-to-node distances override
+    # topology based ones symmetrically.
+    for sourcenode in sorted(node_node_dist.keys()):
+        for destnode in sorted(node_node_dist[sourcenode].keys()):
+            if sourcenode == destnode or not 0 <= destnode < len(dist_rows):
+                continue
+            dist_rows[sourcenode][destnode] = node_node_dist[sourcenode][destnode]
+            dist_rows[destnode][sourcenode] = node_node_dist[sourcenode][destnode]
+    return dist_rows
+
 def dists(numalist):
-    dist_dict = {} # Return value: {sourcenode: {destnode: dist}}, fully defined for all nodes
     sourcenode = -1
     lastsocket = -1
     dist_same_die = DEFAULT_DIST_SAME_DIE
     dist_same_package = DEFAULT_DIST_SAME_PACKAGE
     dist_other_package = DEFAULT_DIST # numalist "dist", if defined
-    node_package_die = {} # topology {node: (package, die)}
+    node_package_die = [] # topology node_package_die[node] == (package, die)
     dist_matrix = None # numalist "dist_matrix", if defined
     node_node_dist = {} # numalist {sourcenode: {destnode: dist}}, if defined for sourcenode
     lastnode_in_group = -1
     for groupindex, numaspec in enumerate(numalist):
         nodecount = int(numaspec.get("nodes", 1))
-        corecount = int(numaspec.get("cores", 0))
         diecount = int(numaspec.get("dies", 1))
         packagecount = int(numaspec.get("packages", 1))
         first_node_in_group = sourcenode + 1
@@ -163,8 +210,7 @@ def dists(numalist):
             for die in range(diecount):
                 for node in range(nodecount):
                     sourcenode += 1
-                    dist_dict[sourcenode] = {}
-                    node_package_die[sourcenode] = (lastsocket, die)
+                    node_package_die.append((lastsocket, die))
         lastnode_in_group = sourcenode + 1
         if "dist" in numaspec:
             dist = numaspec["dist"]
@@ -181,33 +227,18 @@ def dists(numalist):
         raise ValueError('no NUMA nodes found')
     lastnode = lastnode_in_group - 1
     if dist_matrix is not None:
-        # Fill the dist_dict directly from dist_matrix.
-        # It must cover all distances.
+        # Use dist_matrix directly, it must cover all distances.
         if len(dist_matrix) != lastnode + 1:
             raise ValueError("wrong dimensions in dist-all %s rows seen, %s expected" % (len(dist_matrix), lastnode))
         for sourcenode, row in enumerate(dist_matrix):
             if len(row) != lastnode + 1:
                 raise ValueError("wrong dimensions in dist-all on row %s: %s distances seen, %s expected" % (sourcenode + 1, len(row), lastnode + 1))
-            for destnode, source_dest_dist in enumerate(row):
-                dist_dict[sourcenode][destnode] = source_dest_dist
+        dist_rows = [list(row) for row in dist_matrix]
     else:
-        for sourcenode in range(lastnode + 1):
-            for destnode in range(lastnode + 1):
-                if sourcenode == destnode:
-                    dist_dict[sourcenode][destnode] = DEFAULT_DIST_SAME_NODE
-                elif sourcenode in node_node_dist and destnode in node_node_dist[sourcenode]:
-                    # User specified explicit node-to-node distance
-                    dist_dict[sourcenode][destnode] = node_node_dist[sourcenode][destnode]
-                    dist_dict[destnode][sourcenode] = node_node_dist[sourcenode][destnode]
-                elif not destnode in dist_dict[sourcenode]:
-                    # Set distance based on topology
-                    if node_package_die[sourcenode] == node_package_die[destnode]:
-                        dist_dict[sourcenode][destnode] = dist_same_die
-                    elif node_package_die[sourcenode][0] == node_package_die[destnode][0]:
-                        dist_dict[sourcenode][destnode] = dist_same_package
-                    else:
-                        dist_dict[sourcenode][destnode] = dist_other_package
-    return dist_dict
+        dist_rows = fill_dists(node_package_die, node_node_dist,
+                               dist_same_die, dist_same_package, dist_other_package)
+    # Return value: dist_rows[sourcenode][destnode] == dist, fully defined for all nodes
+    return dist_rows
 
 def qemuopts(numalist):
     machineparam = "-machine pc"
@@ -220,10 +251,10 @@ def qemuopts(numalist):
     lastsocket = -1
     lastmem = -1
     lastnvmem = -1
-    totalmem = "0G"
-    totalnvmem = "0G"
-    unpluggedmem = "0G"
-    pluggedmem = "0G"
+    totalmem = 0 # sizes in megabytes
+    totalnvmem = 0
+    unpluggedmem = 0
+    pluggedmem = 0
     memslots = 0
     groupnodes = {} # groupnodes[NUMALISTINDEX] = (NODEID, ...)
     validate(numalist)
@@ -232,34 +263,48 @@ def qemuopts(numalist):
     threadcount = -1
     for numalistindex, numaspec in enumerate(numalist):
         nodecount = int(numaspec.get("nodes", 1))
-        groupnodes[numalistindex] = tuple(range(lastnode + 1, lastnode + 1 + nodecount))
         corecount = int(numaspec.get("cores", 0))
+        threads = numaspec.get("threads", None)
+        diecount = int(numaspec.get("dies", 1))
+        packagecount = int(numaspec.get("packages", 1))
+        groupnodes[numalistindex] = tuple(range(lastnode + 1, lastnode + 1 + nodecount))
         if corecount > 0:
             if threadcount < 0:
                 # threads per cpu, set only once based on the first cpu-ful numa node
-                threadcount = int(numaspec.get("threads", 2))
+                threadcount = int(threads) if threads is not None else 2
                 threads_set_node = numaspec
             else:
                 # threadcount already set, only check that there is no mismatch
-                if (numaspec.get("threads", None) is not None and
-                    threadcount != int(numaspec.get("threads"))):
+                if threads is not None and threadcount != int(threads):
                     raise ValueError('all CPUs must have the same number of threads, '
                                      'but %r had %s threads (the default) which contradicts %r' %
                                      (threads_set_node, threadcount, numaspec))
-        cpucount = int(numaspec.get("cores", 0)) * threadcount # logical cpus per numa node (cores * threads)
-        diecount = int(numaspec.get("dies", 1))
-        packagecount = int(numaspec.get("packages", 1))
+        cpucount = corecount * threadcount # logical cpus per numa node (cores * threads)
         memsize = numaspec.get("mem", "0")
-        memdimm = numaspec.get("dimm", "")
-        if memsize != "0":
-            memcount = 1
-        else:
-            memcount = 0
+        memsize_mb = si2mb(memsize)
         nvmemsize = numaspec.get("nvmem", "0")
-        if nvmemsize != "0":
-            nvmemcount = 1
-        else:
-            nvmemcount = 0
+        nvmemsize_mb = si2mb(nvmemsize)
+        groupnodecount = packagecount * diecount * nodecount
+        groupslots = groupnodecount * ((memsize != "0") + (nvmemsize != "0"))
+        # Resolve how memory is attached once for the whole group.
+        memdimm = numaspec.get("dimm", "")
+        if memdimm == "":
+            memid, nvmemid = "membuiltin", "memnvbuiltin"
+            memdevice, nvmemdevice = None, None
+        elif memdimm == "plugged":
+            memid, nvmemid = "memdimm", "memnvdimm"
+            memdevice, nvmemdevice = PC_DIMM_DEVICE, NVDIMM_DEVICE
+            pluggedmem += groupnodecount * (memsize_mb + nvmemsize_mb)
+            memslots += groupslots
+        elif memdimm == "unplugged":
+            memid, nvmemid = "memdimm", "memnvdimm"
+            memdevice, nvmemdevice = None, None
+            unpluggedmem += groupnodecount * (memsize_mb + nvmemsize_mb)
+            memslots += groupslots
+        elif groupslots:
+            raise ValueError("unsupported dimm %r, expected 'plugged' or 'unplugged'" % (memdimm,))
+        totalmem += groupnodecount * memsize_mb
+        totalnvmem += groupnodecount * nvmemsize_mb
         for package in range(packagecount):
             if nodecount > 0 and cpucount > 0:
                 lastsocket += 1
@@ -269,33 +314,17 @@ def qemuopts(numalist):
                 for node in range(nodecount):
                     lastnode += 1
                     currentnumaparams = []
-                    for mem in range(memcount):
+                    if memsize != "0":
                         lastmem += 1
+                        memdev = MEMDEV_ID % (memid, lastmem, lastnode)
+                        objectparams.extend(("-object", MEMORY_BACKEND % (memsize, memdev)))
                         if memdimm == "":
-                            objectparams.append("-object")
-                            objectparams.append("memory-backend-ram,size=%s,id=membuiltin_%s_node_%s" % (memsize, lastmem, lastnode))
-                            currentnumaparams.append("-numa")
-                            currentnumaparams.append("node,nodeid=%s,memdev=membuiltin_%s_node_%s" % (lastnode, lastmem, lastnode))
-                        elif memdimm == "plugged":
-                            objectparams.append("-object")
-                            objectparams.append("memory-backend-ram,size=%s,id=memdimm_%s_node_%s" % (memsize, lastmem, lastnode))
-                            currentnumaparams.append("-numa")
-                            currentnumaparams.append("node,nodeid=%s" % (lastnode,))
-                            deviceparams.append("-device")
-                            deviceparams.append("pc-dimm,node=%s,id=dimm%s,memdev=memdimm_%s_node_%s" % (lastnode, lastmem, lastmem, lastnode))
-                            pluggedmem = siadd(pluggedmem, memsize)
-                            memslots += 1
-                        elif memdimm == "unplugged":
-                            objectparams.append("-object")
-                            objectparams.append("memory-backend-ram,size=%s,id=memdimm_%s_node_%s" % (memsize, lastmem, lastnode))
-                            currentnumaparams.append("-numa")
-                            currentnumaparams.append("node,nodeid=%s" % (lastnode,))
-                            unpluggedmem = siadd(unpluggedmem, memsize)
-                            memslots += 1
+                            currentnumaparams.extend(("-numa", NUMA_NODE_MEMDEV % (lastnode, memdev)))
                         else:
-                            raise ValueError("unsupported dimm %r, expected 'plugged' or 'unplugged'" % (memdimm,))
-                        totalmem = siadd(totalmem, memsize)
-                    for nvmem in range(nvmemcount):
+                            currentnumaparams.extend(("-numa", NUMA_NODE % (lastnode,)))
+                        if memdevice:
+                            deviceparams.extend(("-device", memdevice % (lastnode, lastmem, memdev)))
+                    if nvmemsize != "0":
                         lastnvmem += 1
                         lastmem += 1
                         if lastnvmem == 0:
@@ -303,45 +332,24 @@ def qemuopts(numalist):
                         # Don't use file-backed nvdimms because the file would
                         # need to be accessible from the govm VM
                         # container. Everything is ram-backed on host for now.
+                        memdev = MEMDEV_ID % (nvmemid, lastmem, lastnode)
+                        objectparams.extend(("-object", MEMORY_BACKEND % (nvmemsize, memdev)))
                         if memdimm == "":
-                            objectparams.append("-object")
-                            objectparams.append("memory-backend-ram,size=%s,id=memnvbuiltin_%s_node_%s" % (nvmemsize, lastmem, lastnode))
-                            currentnumaparams.append("-numa")
-                            currentnumaparams.append("node,nodeid=%s,memdev=memnvbuiltin_%s_node_%s" % (lastnode, lastmem, lastnode))
-                        elif memdimm == "plugged":
-                            objectparams.append("-object")
-                            objectparams.append("memory-backend-ram,size=%s,id=memnvdimm_%s_node_%s" % (nvmemsize, lastmem, lastnode))
-                            currentnumaparams.append("-numa")
-                            currentnumaparams.append("node,nodeid=%s" % (lastnode,))
-                            deviceparams.append("-device")
-                            deviceparams.append("nvdimm,node=%s,id=nvdimm%s,memdev=memnvdimm_%s_node_%s" % (lastnode, lastmem, lastmem, lastnode))
-                            pluggedmem = siadd(pluggedmem, nvmemsize)
-                            memslots += 1
-                        elif memdimm == "unplugged":
-                            objectparams.append("-object")
-                            objectparams.append("memory-backend-ram,size=%s,id=memnvdimm_%s_node_%s" % (nvmemsize, lastmem, lastnode))
-                            currentnumaparams.append("-numa")
-                            currentnumaparams.append("node,nodeid=%s" % (lastnode,))
-                            unpluggedmem = siadd(unpluggedmem, nvmemsize)
-                            memslots += 1
+                            currentnumaparams.extend(("-numa", NUMA_NODE_MEMDEV % (lastnode, memdev)))
                         else:
-                            raise ValueError("unsupported dimm %r, expected 'plugged' or 'unplugged'" % (memdimm,))
-                        totalnvmem = siadd(totalnvmem, nvmemsize)
+                            currentnumaparams.extend(("-numa", NUMA_NODE % (lastnode,)))
+                        if nvmemdevice:
+                            deviceparams.extend(("-device", nvmemdevice % (lastnode, lastmem, memdev)))
                     if cpucount > 0:
                         if not currentnumaparams:
-                            currentnumaparams.append("-numa")
-                            currentnumaparams.append("node,nodeid=%s" % (lastnode,))
-                        currentnumaparams[-1] = currentnumaparams[-1] + (",cpus=%s-%s" % (lastcpu + 1, lastcpu + cpucount))
+                            currentnumaparams.extend(("-numa", NUMA_NODE % (lastnode,)))
+                        currentnumaparams[-1] = currentnumaparams[-1] + NUMA_NODE_CPUS % (lastcpu + 1, lastcpu + cpucount)
                         lastcpu += cpucount
                     numaparams.extend(currentnumaparams)
-    node_node_dist = dists(numalist)
-    for sourcenode in sorted(node_node_dist.keys()):
-        for destnode in sorted(node_node_dist[sourcenode].keys()):
-            if sourcenode == destnode:
-                continue
-            numaparams.append("-numa")
-            numaparams.append("dist,src=%s,dst=%s,val=%s" % (
-                sourcenode, destnode, node_node_dist[sourcenode][destnode]))
+    numaparams.extend(param
+                      for sourcenode, row in enumerate(dists(numalist))
+                      for destnode, dist in enumerate(row) if sourcenode != destnode
+                      for param in ("-numa", NUMA_DIST % (sourcenode, destnode, dist)))
     if lastcpu == -1:
         raise ValueError('no CPUs found, make sure at least one NUMA node has "cores" > 0')
     if (lastdie + 1) // (lastsocket + 1) > 1:
@@ -351,11 +359,11 @@ def qemuopts(numalist):
         # because it requires Qemu >= 5.0.
         diesparam = ""
     cpuparam = "-smp cpus=%s,threads=%s%s,sockets=%s" % (lastcpu + 1, threadcount, diesparam, lastsocket + 1)
-    maxmem = siadd(totalmem, totalnvmem)
-    startmem = sisub(sisub(maxmem, unpluggedmem), pluggedmem)
-    memparam = "-m size=%s,slots=%s,maxmem=%s" % (startmem, memslots, maxmem)
-    if startmem.startswith("0"):
-        if pluggedmem.startswith("0"):
+    maxmem = totalmem + totalnvmem
+    startmem = maxmem - unpluggedmem - pluggedmem
+    memparam = "-m size=%s,slots=%s,maxmem=%s" % (mb2si(startmem), memslots, mb2si(maxmem))
+    if startmem == 0:
+        if pluggedmem == 0:
             raise ValueError('no memory in any NUMA node')
         raise ValueError("no initial memory in any NUMA node - cannot boot with hotpluggable memory")
 
@@ -397,7 +405,7 @@ if __name__ == "__main__":
             print(__doc__)
             sys.exit(0)
         else:
-            input_file = open(sys.argv[1])
+            input_file = open(sys.argv[1], "rb")
     else:
-        input_file = sys.stdin
+        input_file = sys.stdin.buffer
     main(input_file)
@@ -1,6 +1,18 @@
+import numpy as np
 import requests
 import argparse
+import atexit
+import concurrent.futures
+import csv
+import shelve
 import sys
+import threading
+import urllib.parse
+
+try:
+    import orjson as json
+except ImportError:
+    import json
 
 # OPERATION_NAMES = ["runtime.v1.RuntimeService/RunPodSandbox",
 #                    "runtime.v1.RuntimeService/CreateContainer",
@@ -10,27 +22,30 @@ import sys
 #                    "runtime.v1.RuntimeService/StopPodSandbox",
 #                    "runtime.v1.RuntimeService/RemovePodSandbox"]
 
-def createCsvFromResult(processedDict):
-    result = "{},{},{}\n".format("name", "timestamp", "duration (milliseconds)")
-    for key in processedDict:
-        operationSpans = processedDict[key]
-        for span in operationSpans:
-            # Note, times in microseconds (divide by 1000000 to get seconds)!
-            result += "{},{},{}\n".format(key, str(span["startTime"] / 1000000), str(span["duration"] / 1000))
+# All queries go to the same Jaeger instance, reuse connections between them.
+SESSION = requests.Session()
+atexit.register(SESSION.close)
 
-    return result
+# Query responses from earlier runs, see --cache.
+CACHE = None
+CACHE_LOCK = threading.Lock()
+
+def writeCsvFromResult(writer, processedDict):
+    writer.writerow(("name", "timestamp", "duration (milliseconds)"))
+    for key in processedDict:
+        startTimes, durations = processedDict[key]
+        writer.writerows((key, startTime, duration) for startTime, duration in zip(startTimes.tolist(), durations.tolist()))
 
 def createTextOutputFromResult(processedDict):
-    result = ""
+    result = []
     for key in processedDict:
-        operationSpans = processedDict[key]
-        result += "{}, {} durations:\n{:40s} {}\n".format(key, len(operationSpans), "startTime", "duration")
-        for span in operationSpans:
-            # Note, times in microseconds (divide by 1000000 to get seconds)!
-            result += "{:40s} {}\n".format(str(span["startTime"] / 1000000), str(span["duration"] / 1000))
-        result += "\n"
+        startTimes, durations = processedDict[key]
+        result.append(f"{key}, {len(startTimes)} durations:\n{'startTime':40s} duration\n")
+        for startTime, duration in zip(startTimes.tolist(), durations.tolist()):
+            result.append(f"{str(startTime):40s} {duration}\n")
+        result.append("\n")
 
-    return result
+    return "".join(result)
 
 
 def processSpansAndTraces(url, start, end, runtime):
@@ -43,9 +58,12 @@ def processSpansAndTraces(url, start, end, runtime):
         "runtime.v1.RuntimeService/StopPodSandbox": [],
         "runtime.v1.RuntimeService/RemovePodSandbox": []
     }
-    for key in result:
-        output = getQueryOutput(url, key, start, end, runtime)
+    # Operations are queried independently, run the queries in parallel.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(result)) as executor:
+        keys = list(result)
+        outputs = list(executor.map(lambda key: getQueryOutput(url, key, start, end, runtime), keys))
 
+    for key, output in zip(keys, outputs):
         if output["errors"] != None:
             print("query for operation {} failed".format(key))
 
@@ -53,34 +71,65 @@ def processSpansAndTraces(url, start, end, runtime):
         if len(traceList) == 0:
             print("no results for operation {}".format(key))
 
+        # Traces may contain spans of other operations too. Those are
+        # collected from the queries of their own operations, picking
+        # them up here would only add duplicates. Only the times of the
+        # spans are needed, keep them instead of the span dicts.
+        # crio has /runtime.v1... in the operationName
+        startTimes = []
+        durations = []
         for trace in traceList:
-            spans = trace["spans"]
-            for span in spans:
-                operationName = span["operationName"]
-
-                # crio has /runtime.v1... in the operationName
-                operationName.lstrip("/")
-
-                if operationName in result:
-                    result[operationName].append(span)
-        
-        result[key].sort(key=lambda datapoint: datapoint["startTime"])
-
-        for datapoint in result[key]:
-            datapoint["startTime"] -= start
+            for span in trace["spans"]:
+                if span["operationName"].lstrip("/") == key:
+                    startTimes.append(span["startTime"])
+                    durations.append(span["duration"])
+
+        # Sort spans by start time. Jaeger times are in microseconds, convert
+        # start times to seconds since start and durations to milliseconds.
+        startTimes = np.array(startTimes, dtype=np.int64)
+        durations = np.array(durations, dtype=np.int64)
+        order = np.argsort(startTimes, kind="stable")
+        result[key] = ((startTimes[order] - start) / 1000000, durations[order] / 1000)
 
     return result
 
 def getQueryOutput(url, operationName, start, end, runtime):
-    return requests.get(url + "/api/traces", { "service": runtime, "operation": operationName, "start": start, "end": end}).json()
-
-def handleQueryOutput(url, csv, start, end, runtime):
+    url = url + "/api/traces"
+    params = { "service": runtime, "operation": operationName, "start": start, "end": end}
+    key = cacheKey(url, params)
+    output = cacheGet(key)
+    if output is None:
+        output = json.loads(SESSION.get(url, params).content)
+        if output["errors"] == None:
+            cachePut(key, output)
+    return output
+
+def openCache(filename):
+    global CACHE
+    CACHE = shelve.open(filename)
+    atexit.register(CACHE.close)
+
+def cacheKey(url, params):
+    return url + "?" + urllib.parse.urlencode(sorted(params.items()))
+
+def cacheGet(key):
+    with CACHE_LOCK:
+        if CACHE is not None and key in CACHE:
+            return CACHE[key]
+    return None
+
+def cachePut(key, output):
+    with CACHE_LOCK:
+        if CACHE is not None:
+            CACHE[key] = output
+
+def handleQueryOutput(url, csvFile, start, end, runtime):
     processedDict = processSpansAndTraces(url, start, end, runtime)
 
-    if csv is not None:
-        with open(csv, "w+") as csv_file:
-            csv_file.write(createCsvFromResult(processedDict))
-            return "csv output written to " + csv
+    if csvFile is not None:
+        with open(csvFile, "w", newline="") as csv_file:
+            writeCsvFromResult(csv.writer(csv_file, lineterminator="\n"), processedDict)
+            return "csv output written to " + csvFile
     else:
         return createTextOutputFromResult(processedDict)
     
@@ -92,8 +141,12 @@ def main():
     parser.add_argument("-s", "--start", type=int, help="the start of the Jaeger tracing query interval as UTC timestamp in seconds")
     parser.add_argument("-e", "--end", type=int, help="the end of the Jaeger tracing query interval as UTC timestamp in seconds")
     parser.add_argument("-r", "--runtime", help="container runtime name (containerd or crio), default is containerd", required = False, default = "containerd")
+    parser.add_argument("--cache", help="file for caching query responses, reruns with the same interval are answered from it")
     args = parser.parse_args(sys.argv[1:])
 
+    if args.cache is not None:
+        openCache(args.cache)
+
     # Jaeger tracing uses microseconds.
     print(handleQueryOutput(args.url, args.csv, int(args.start) * 1000000, int(args.end) * 1000000, args.runtime))
 
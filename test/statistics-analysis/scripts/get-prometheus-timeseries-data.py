@@ -1,86 +1,129 @@
 import requests
 import argparse
+import atexit
+import concurrent.futures
+import csv
+import shelve
 import sys
+import threading
 import time
+import urllib.parse
+from operator import itemgetter
 
-def createCsvFromResult(inputValues):
-    result = "{},{},{}\n".format("name", "timestamp", "value")
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+# All queries go to the same Prometheus instance, reuse connections between them.
+SESSION = requests.Session()
+atexit.register(SESSION.close)
+
+# Query responses from earlier runs, see --cache.
+CACHE = None
+CACHE_LOCK = threading.Lock()
+
+def writeCsvFromResult(writer, inputValues):
+    writer.writerow(("name", "timestamp", "value"))
     for key in inputValues:
         values = inputValues[key]["values"]
         for value in values:
-            result += "{},{},{}\n".format(value["label"], str(value["time"]), value["value"])
-
-    return result
+            writer.writerow((value["label"], value["time"], value["value"]))
 
 def createTextOutputFromResult(inputValues):
-    result = ""
+    result = []
     for key in inputValues:
         values = inputValues[key]["values"]
         metric = inputValues[key]["metric"]
 
-        result += "\nquery: {}\n".format(key)
-        result += "\nmetric:\n{:40s} {}\n".format("field", "value")
-        for key in metric:
-            result += "{:40s} {}\n".format(key, metric[key])
+        result.append(f"\nquery: {key}\n")
+        result.append(f"\nmetric:\n{'field':40s} value\n")
+        for field in metric:
+            result.append(f"{field:40s} {metric[field]}\n")
 
-        result += "\n{} datapoints:\n{:70s} {:30s} {}\n".format(len(values), "query", "time", "value")
+        result.append(f"\n{len(values)} datapoints:\n{'query':70s} {'time':30s} value\n")
         for value in values:
-            result += "{:70s} {:30s} {}\n".format(value["label"], str(value["time"]), value["value"])
+            result.append(f"{value['label']:70s} {str(value['time']):30s} {value['value']}\n")
 
-    return result
+    return "".join(result)
 
 
-def processValues(url, queries, labels, start, end):
-    result = {}
-    for i in range(len(queries)):
-        query = queries[i]
-        label = labels[i]
-        queryOutput = getQueryOutput(url, query, start, end)
-        if queryOutput["status"] != "success":
-            print("request failed")
-            sys.exit(1)
-        
-        resultList = queryOutput["data"]["result"]
-        if len(resultList) == 0:
-            print("no results from query")
-            sys.exit(1)
+def processQuery(url, query, label, start, end):
+    queryOutput = getQueryOutput(url, query, start, end)
+    if queryOutput["status"] != "success":
+        print("request failed")
+        sys.exit(1)
 
-        if len(resultList) > 1:
-            print("error: more than one result found")
-            sys.exit(1) 
-        
-        queryResult = resultList[0]
-        values = []
-        for value in queryResult["values"]:
-            values.append({"label": label, "time": value[0] - start, "value": value[1]})
+    resultList = queryOutput["data"]["result"]
+    if len(resultList) == 0:
+        print("no results from query")
+        sys.exit(1)
 
-        values.sort(key=lambda datapoint: datapoint["time"])
-        result[query] = {"values": values, "metric": queryResult["metric"]}
+    if len(resultList) > 1:
+        print("error: more than one result found")
+        sys.exit(1)
 
-    return result
+    queryResult = resultList[0]
+    values = []
+    for value in queryResult["values"]:
+        values.append({"label": label, "time": value[0] - start, "value": value[1]})
 
-def getQueryOutput(url, query, start, end):
-    r = requests.get(url + "/api/v1/query_range", { "query": query, "start": start, "end": end, "step": 15 })
-    if (r.status_code != 200):
-        print("error: {}, {}\n{}".format(r.status_code, r.reason, r.text))
-        sys.exit(1)
-    return r.json()
+    values.sort(key=itemgetter("time"))
+    return {"values": values, "metric": queryResult["metric"]}
+
+def processValues(url, queries, labels, start, end):
+    # Queries are independent, run them in parallel.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        outputs = list(executor.map(lambda query, label: processQuery(url, query, label, start, end), queries, labels))
+
+    return dict(zip(queries, outputs))
 
-def handleQueryOutput(url, csv, queries, labels, start, end):
+def getQueryOutput(url, query, start, end):
+    url = url + "/api/v1/query_range"
+    params = { "query": query, "start": start, "end": end, "step": 15 }
+    key = cacheKey(url, params)
+    output = cacheGet(key)
+    if output is None:
+        r = SESSION.get(url, params)
+        if (r.status_code != 200):
+            print("error: {}, {}\n{}".format(r.status_code, r.reason, r.text))
+            sys.exit(1)
+        output = json.loads(r.content)
+        if output["status"] == "success":
+            cachePut(key, output)
+    return output
+
+def openCache(filename):
+    global CACHE
+    CACHE = shelve.open(filename)
+    atexit.register(CACHE.close)
+
+def cacheKey(url, params):
+    return url + "?" + urllib.parse.urlencode(sorted(params.items()))
+
+def cacheGet(key):
+    with CACHE_LOCK:
+        if CACHE is not None and key in CACHE:
+            return CACHE[key]
+    return None
+
+def cachePut(key, output):
+    with CACHE_LOCK:
+        if CACHE is not None:
+            CACHE[key] = output
+
+def handleQueryOutput(url, csvFile, queries, labels, start, end):
     result = processValues(url, queries, labels, start, end)
-    
-    if csv is not None:
-        with open(csv, "w+") as csv_file:
-            csv_file.write(createCsvFromResult(result))
-            return "csv output written to " + csv
+
+    if csvFile is not None:
+        with open(csvFile, "w", newline="") as csv_file:
+            writeCsvFromResult(csv.writer(csv_file, lineterminator="\n"), result)
+            return "csv output written to " + csvFile
 
     return createTextOutputFromResult(result)
 
 def parseCommaSeparatedString(arg):
-    splitList = arg.split(",")
-    for element in splitList:
-        element.strip()
-    return splitList
+    return [element.strip() for element in arg.split(",") if element.strip()]
 
 def main():
     parser = argparse.ArgumentParser(description="Get prometheus timeseries data. Example queries: "
@@ -88,17 +131,23 @@ def main():
                                                  "\"container_memory_usage_bytes\", and "
                                                  "\"container_memory_working_set_bytes\".")
     parser.add_argument("url", help="url for accessing prometheus")
-    parser.add_argument("-q", "--queries", required=True, help="the Prometheus queries to use separated by commas (this unfortunately limits some Prometheus queries)")
-    parser.add_argument("-l", "--labels", required=True, help="labels for csv data for each query")
+    parser.add_argument("-q", "--queries", required=True, help="the Prometheus queries to use separated by commas (this unfortunately limits some Prometheus queries)", type=parseCommaSeparatedString)
+    parser.add_argument("-l", "--labels", required=True, help="labels for csv data for each query", type=parseCommaSeparatedString)
     parser.add_argument("-d", "--duration", type=int, default=60, help="the duration in seconds which ends in the time the program was run")
     parser.add_argument("-s", "--start", type=int, help="the start of the Prometheus query interval as UTC timestamp in seconds")
     parser.add_argument("-e", "--end", type=int, help="the end of the Prometheus query interval as UTC timestamp in seconds")
     parser.add_argument("-c", "--csv", help="output csv file, otherwise print out json data")
+    parser.add_argument("--cache", help="file for caching query responses, reruns with the same interval are answered from it")
     args = parser.parse_args(sys.argv[1:])
 
+    if args.cache is not None:
+        openCache(args.cache)
 
-    queries = parseCommaSeparatedString(args.queries)
-    labels = parseCommaSeparatedString(args.labels)
+    queries = args.queries
+    labels = args.labels
+    if not queries:
+        print("no queries given")
+        sys.exit(1)
     if (len(labels) != len(queries)):
         print("there should be an equal amount of queries and labels")
         sys.exit(1)
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import pandas as pd
 import argparse
+import json
 import sys
 import os
 
@@ -13,28 +16,6 @@ LABEL_COLORS = {
     "balloons": "blue"
 }
 
-def add_to_subplots_with_color(df, color):
-    i = 1
-    df_grouped = df.groupby("name")
-    for title, group in df_grouped:
-        ax = plt.subplot(4, 2, i)
-        y_axis_label = group.columns[2]
-        group.plot(x="timestamp", y=y_axis_label, ax=ax, legend=True, title=title, color=color)
-        ax.set_xlabel("timestamp (seconds)")
-        ax.set_ylabel(y_axis_label)
-        i += 1
-
-def add_to_subplots(df):
-    i = 1
-    df_grouped = df.groupby("name")
-    for title, group in df_grouped:
-        ax = plt.subplot(4, 2, i)
-        y_axis_label = group.columns[2]
-        group.plot(x="timestamp", y=y_axis_label, ax=ax, legend=True, title=title)
-        ax.set_xlabel("timestamp (seconds)")
-        ax.set_ylabel(y_axis_label)
-        i += 1
-
 def add_params(args):
     if args.increments == None and args.containers == None and args.workload == None and args.prefix == None:
         return
@@ -57,27 +38,35 @@ def add_params(args):
         ax.text(0.05, y, ("workload used: %s" % args.workload))
 
 def createGraph(labels, inputFiles, args):
-    plt.figure(figsize=(12, 12))
-
-    for file in inputFiles:
-        df = pd.read_csv(file)
+    fig = plt.figure(figsize=(12, 12))
 
+    frames = []
+    colors = {}
+    for label, file in zip(labels, inputFiles):
+        df = pd.read_csv(file, usecols=[0, 1, 2], engine="c",
+                         dtype={"name": "category", "timestamp": "float64"})
+        frames.append(df.assign(source=label))
 
-        # Check if predetermined color exists.
-        colorFound = False
+        # Use predetermined color if one exists.
+        colors[label] = None
         for key in LABEL_COLORS:
             if key in file:
-                add_to_subplots_with_color(df, LABEL_COLORS[key])
-                colorFound = True
+                colors[label] = LABEL_COLORS[key]
                 break
-            
-        if not colorFound:
-            add_to_subplots(df)
 
-    figure_axes = plt.gcf().axes
-    handles, old_labels = figure_axes[0].get_legend_handles_labels()
-    for ax in figure_axes:
-        ax.get_legend().remove()
+    df = pd.concat(frames, ignore_index=True)
+    y_axis_label = df.columns[2]
+
+    # One subplot per name, with a line for each input file in it.
+    for i, (title, group) in enumerate(df.groupby("name", observed=True), start=1):
+        ax = plt.subplot(4, 2, i)
+        ax.set_title(title)
+        ax.set_xlabel("timestamp (seconds)")
+        ax.set_ylabel(y_axis_label)
+        for source, sourceGroup in group.groupby("source", sort=False):
+            ax.plot(sourceGroup["timestamp"], sourceGroup[y_axis_label], label=source, color=colors[source])
+
+    handles, labels = fig.axes[0].get_legend_handles_labels()
 
     plt.tight_layout()
     plt.figlegend(handles, labels, loc='lower right')
@@ -85,6 +74,8 @@ def createGraph(labels, inputFiles, args):
     add_params(args)
 
     plt.savefig(args.output)
+    plt.close(fig)
+
     result = "created {}, input files used:".format(args.output)
     for file in inputFiles:
         result += "\n" + file
@@ -92,25 +83,17 @@ def createGraph(labels, inputFiles, args):
     return result
 
 def scanCsvFiles(directory, labels, prefix):
-    result = []
-    directoryContents = os.listdir(directory)
-    result_count = 0
+    with os.scandir(directory) as entries:
+        csvFiles = [entry.name for entry in entries
+                    if entry.name.endswith(".csv") and (not prefix or prefix in entry.name)]
 
+    result = []
     for label in labels:
-        for element in directoryContents:
-            if element.endswith(".csv"):
-                if prefix != None and prefix != "":
-                    if (prefix in element) and (label in element):
-                        result.append(directory + "/" + element)
-                        result_count += 1
-                else:
-                    if label in element:
-                        result.append(directory + "/" + element)
-                        result_count += 1
-
-    if len(labels) != result_count:
-        print("matching csv files for all labels not found")
-        sys.exit(1)
+        matches = [name for name in csvFiles if label in name]
+        if len(matches) != 1:
+            print("matching csv files for all labels not found")
+            sys.exit(1)
+        result.append(directory + "/" + matches[0])
 
     return result
 
@@ -136,19 +119,47 @@ def main():
         sys.exit(0)
 
     parser = argparse.ArgumentParser(description="Get jaeger tracing data.")
-    parser.add_argument("directory", help="directory containing output to scan")
-    parser.add_argument("-l", "--labels", required=True, help="comma-separated list of labels used in the test setups")
-    parser.add_argument("-o", "--output", required=True, help="the output file")
+    parser.add_argument("directory", nargs="?", help="directory containing output to scan")
+    parser.add_argument("-l", "--labels", help="comma-separated list of labels used in the test setups")
+    parser.add_argument("-o", "--output", help="the output file")
     parser.add_argument("-p", "--prefix", required=False, help="prefix of the output files")
     parser.add_argument("-i", "--increments", required=False, help="number of increments")
     parser.add_argument("-n", "--containers", required=False, help="containers per increment")
     parser.add_argument("-w", "--workload", required=False, help="workload")
+    parser.add_argument("-m", "--manifest", required=False, help="JSON file with a list of graphs to plot, each an object with the above options as keys")
     args = parser.parse_args(sys.argv[1:])
 
+    if args.manifest != None:
+        for graphArgs in readManifest(args.manifest):
+            plotGraph(graphArgs)
+        return
+
+    if args.directory == None or args.labels == None or args.output == None:
+        parser.error("directory, -l/--labels and -o/--output are required without -m/--manifest")
+
+    plotGraph(args)
+
+def plotGraph(args):
     labels, stripped = parseLabels(args.labels)
     inputFiles = scanCsvFiles(args.directory, labels, args.prefix)
 
     print(createGraph(stripped, inputFiles, args))
 
+def readManifest(manifest):
+    with open(manifest) as f:
+        entries = json.load(f)
+
+    result = []
+    for entry in entries:
+        for key in ("directory", "labels", "output"):
+            if key not in entry:
+                print("manifest entry %s has no %s" % (entry, key))
+                sys.exit(1)
+        args = argparse.Namespace(prefix=None, increments=None, containers=None, workload=None)
+        vars(args).update(entry)
+        result.append(args)
+
+    return result
+
 if __name__ == "__main__":
     main()